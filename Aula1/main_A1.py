@@ -7,32 +7,152 @@ Aula 1 - Lógica de Programação e Python Intermediário/Avançado para Engenha
 # Importações
 # ============================================================================
 
-from typing import List, Dict, Optional, Any
+from typing import (
+    List,
+    Dict,
+    Optional,
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Sequence,
+    Tuple,
+)
 from datetime import datetime
+from functools import lru_cache
+from itertools import accumulate
+import ast
 import asyncio
+import atexit
+import hashlib
 import json
+import logging
+import logging.handlers
+import operator
 import os
+import queue
 import re
+import time
 from dataclasses import dataclass, field
 from enum import Enum
+from pathlib import Path
 
+import numpy as np
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
+from google.ai.generativelanguage_v1beta.services.generative_service import (
+    GenerativeServiceAsyncClient,
+)
+from google.ai.generativelanguage_v1beta.services.generative_service.transports import (
+    GenerativeServiceGrpcAsyncIOTransport,
+)
+
+try:
+    import orjson  # Serializador JSON em C, usado quando disponível
+except ImportError:
+    orjson = None
 
 # Define diretório base do script
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Carrega variáveis de ambiente (procura .env na raiz do projeto, um nível acima)
+# Arquivo .env na raiz do projeto, um nível acima. Carregado já no import, pois
+# também traz configurações lidas aqui (ex.: AGENTE_LOG_LEVEL); a chave da API
+# só é exigida ao criar o primeiro agente (_configure_once)
 dotenv_path = os.path.join(BASE_DIR, "..", ".env")
 load_dotenv(dotenv_path)
 
-# Configura Gemini
-if not os.getenv("GOOGLE_API_KEY"):
-    raise ValueError(
-        f"GOOGLE_API_KEY não encontrada no arquivo .env (buscado em: {dotenv_path})"
-    )
+# Logger do agente: as mensagens vão para uma fila e são escritas no terminal
+# por uma thread separada, sem bloquear o event loop com I/O
+logger = logging.getLogger("agente")
+_nivel_log = logging.getLevelName(os.getenv("AGENTE_LOG_LEVEL", "INFO").upper())
+# Nível desconhecido (ex.: "VERBOSE") volta para INFO em vez de falhar no import
+logger.setLevel(_nivel_log if isinstance(_nivel_log, int) else logging.INFO)
+logger.propagate = False
+_fila_log: queue.SimpleQueue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_fila_log))
+_saida_log = logging.StreamHandler()
+_saida_log.setFormatter(logging.Formatter("%(message)s"))
+_ouvinte_log = logging.handlers.QueueListener(_fila_log, _saida_log)
+_ouvinte_log.start()
+atexit.register(_ouvinte_log.stop)  # Esvazia a fila antes de encerrar
+
+_configurado = False  # Indica se o Gemini já foi configurado neste processo
+
+
+def _configure_once():
+    """Valida a chave do .env e configura o Gemini uma única vez"""
+    global _configurado
+    if _configurado:
+        return
+
+    if not os.getenv("GOOGLE_API_KEY"):
+        raise ValueError(
+            f"GOOGLE_API_KEY não encontrada no arquivo .env (buscado em: {dotenv_path})"
+        )
+
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    _configurado = True
+
+
+@lru_cache(maxsize=8)
+def _get_model(name: str) -> genai.GenerativeModel:
+    """Retorna o cliente Gemini do modelo, criado uma vez e compartilhado"""
+    return genai.GenerativeModel(name)
+
+
+# Cliente das chamadas de geração com keep-alive no canal gRPC: em pausas longas
+# entre mensagens a conexão continua aberta e evita novo handshake TLS/TCP.
+# A biblioteca já reutiliza um cliente por processo; o ganho aqui são só essas
+# opções, e embeddings e cache de contexto seguem com o cliente da biblioteca
+_OPCOES_CANAL = [
+    ("grpc.keepalive_time_ms", 30_000),
+    ("grpc.keepalive_timeout_ms", 10_000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+_cliente_async: Optional[Tuple[asyncio.AbstractEventLoop, Any]] = None
+
+
+def _criar_transporte(**kwargs) -> GenerativeServiceGrpcAsyncIOTransport:
+    """Cria o transporte gRPC assíncrono com as opções de keep-alive"""
+
+    def criar_canal(host, **opcoes):
+        opcoes["options"] = list(opcoes.get("options", [])) + _OPCOES_CANAL
+        return GenerativeServiceGrpcAsyncIOTransport.create_channel(host, **opcoes)
+
+    return GenerativeServiceGrpcAsyncIOTransport(channel=criar_canal, **kwargs)
+
+
+def _cliente_async_compartilhado() -> GenerativeServiceAsyncClient:
+    """Retorna o cliente assíncrono único do processo (um por event loop)"""
+    global _cliente_async
+    loop = asyncio.get_running_loop()
+    if _cliente_async is None or _cliente_async[0] is not loop:
+        cliente = GenerativeServiceAsyncClient(
+            transport=_criar_transporte,
+            client_options={"api_key": os.getenv("GOOGLE_API_KEY")},
+        )
+        _cliente_async = (loop, cliente)
+    return _cliente_async[1]
+
+
+# Modelos com versão explícita (ex.: gemini-2.0-flash-001), exigida pelo cache de contexto
+_VERSAO_MODELO_RE = re.compile(r"-\d{3}$")
+
+
+def _modelo_versionado(nome: str) -> str:
+    """Retorna o nome do modelo com versão estável, como o cache de contexto pede"""
+    return nome if _VERSAO_MODELO_RE.search(nome) else f"{nome}-001"
+
+
+# Padrões usados pela ferramenta de cálculo (compilados uma única vez)
+_EXPR_RE = re.compile(r"([\d\.\s\(\)]*[\+\-\*\/][\d\.\s\(\)\+\-\*\/]*)")
+_NUM_RE = re.compile(r"(\d+)")
 
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+# Gatilhos das ferramentas: uma única varredura identifica qual usar
+_TOOL_RE = re.compile(r"(?P<calc>calcular)|(?P<search>pesquisar)", re.IGNORECASE)
 
 # ============================================================================
 # MODELOS DE DADOS
@@ -48,7 +168,7 @@ class Role(Enum):
     TOOL = "tool"  # TOOL é a mensagem que define a ferramenta que o agente pode usar
 
 
-@dataclass  # @dataclass é um decorador que cria uma classe com métodos especiais
+@dataclass(slots=True)  # slots=True dispensa o __dict__ de cada instância
 class Mensagem:  # Mensagem é uma classe que representa uma mensagem na conversa
     """Representa uma mensagem na conversa"""
 
@@ -60,6 +180,13 @@ class Mensagem:  # Mensagem é uma classe que representa uma mensagem na convers
     metadata: Dict[str, Any] = field(
         default_factory=dict
     )  # Metadata é um dicionário de metadados
+    _role_str: str = field(
+        init=False, repr=False, compare=False
+    )  # Valor do papel pré-calculado, evita role.value a cada uso
+
+    def __post_init__(self):
+        """Pré-calcula o valor do papel"""
+        self._role_str = self.role.value
 
     def to_dict(
         self,
@@ -68,12 +195,12 @@ class Mensagem:  # Mensagem é uma classe que representa uma mensagem na convers
     ]:  # to_dict é um método que converte a mensagem para um dicionário, formato que a API entende
         """Converte para formato da API"""
         return {
-            "role": self.role.value,  # Role é o papel do autor da mensagem
+            "role": self._role_str,  # Role é o papel do autor da mensagem
             "content": self.content,  # Content é o conteúdo da mensagem
         }
 
 
-@dataclass  # @dataclass é um decorador que cria uma classe com métodos especiais
+@dataclass(slots=True)  # slots=True dispensa o __dict__ de cada instância
 class Ferramenta:  # Ferramenta é uma classe que representa uma ferramenta que o agente pode usar
     """Representa uma ferramenta que o agente pode usar"""
 
@@ -83,10 +210,205 @@ class Ferramenta:  # Ferramenta é uma classe que representa uma ferramenta que
 
     def __call__(self, **kwargs) -> Any:
         """Executa a ferramenta"""
-        print(f"Usando ferramenta: {self.nome}")
+        logger.debug("Usando ferramenta: %s", self.nome)
         return self.func(**kwargs)
 
 
+# ========== CACHE DE RESPOSTAS ==========
+
+
+class LLMCache:  # LLMCache é um cache de respostas que evita chamadas repetidas à API
+    """Cache semântico de respostas (hash exato + similaridade de cosseno)
+
+    A busca semântica compara apenas a nova mensagem do usuário e só entre
+    entradas com o mesmo contexto (histórico anterior + resultado das ferramentas),
+    informado pelo chamador como uma chave.
+    """
+
+    def __init__(
+        self,
+        limiar: float = 0.92,  # Similaridade mínima para considerar um acerto
+        ttl: float = 3600.0,  # Tempo de vida das entradas, em segundos
+        modelo_embedding: str = "models/text-embedding-004",  # Modelo de embeddings
+        tamanho_lote: int = 32,  # Máximo de prompts por chamada de embedding
+    ):
+        self.limiar = limiar
+        self.ttl = ttl
+        self.modelo_embedding = modelo_embedding
+        self.tamanho_lote = tamanho_lote
+        self._exatos: Dict[Any, tuple] = {}  # Chave -> (timestamp, resposta)
+        # Contexto -> (matriz E (N, d) normalizada, respostas, timestamps das linhas)
+        self._grupos: Dict[bytes, Tuple[np.ndarray, List[str], List[float]]] = {}
+
+        # Lotes: prompts aguardando embedding e linhas aguardando entrar em E
+        self._pendentes: List[Tuple[str, asyncio.Future]] = []
+        self._insercoes: List[Tuple[bytes, np.ndarray, str, float]] = []
+        self._tarefa_lote: Optional[asyncio.Task] = None  # Envio dos lotes
+
+        # Gerações em andamento, com a mesma chave do acerto exato: chamadores
+        # concorrentes com o mesmo prompt aguardam a resposta que vai ao cache
+        self._em_andamento: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def _chave(prompt: str) -> str:
+        """Gera a chave de acerto exato do prompt"""
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def _expirar(self):
+        """Remove entradas mais antigas que o TTL"""
+        limite = time.monotonic() - self.ttl
+
+        self._exatos = {k: v for k, v in self._exatos.items() if v[0] >= limite}
+
+        for contexto, (matriz, respostas, timestamps) in list(self._grupos.items()):
+            validos = [i for i, ts in enumerate(timestamps) if ts >= limite]
+            if not validos:
+                del self._grupos[contexto]
+            elif len(validos) != len(timestamps):
+                self._grupos[contexto] = (
+                    matriz[validos],
+                    [respostas[i] for i in validos],
+                    [timestamps[i] for i in validos],
+                )
+
+    def buscar_exato(self, prompt: str) -> Optional[str]:
+        """Retorna a resposta de um prompt idêntico, se houver"""
+        return self.buscar_chave(self._chave(prompt))
+
+    def buscar_chave(self, chave: Any) -> Optional[str]:
+        """Retorna a resposta armazenada sob uma chave calculada pelo chamador"""
+        entrada = self._exatos.get(chave)
+        if entrada is None or entrada[0] < time.monotonic() - self.ttl:
+            return None
+        return entrada[1]
+
+    async def embedding(self, prompt: str) -> np.ndarray:
+        """Calcula o embedding L2-normalizado do prompt (agrupado em lotes)"""
+        futuro = asyncio.get_running_loop().create_future()
+        self._pendentes.append((prompt, futuro))
+
+        # Sem envio em andamento, o prompt sai já na próxima volta do loop;
+        # os que chegarem durante uma chamada seguem juntos na seguinte
+        if self._tarefa_lote is None or self._tarefa_lote.done():
+            self._tarefa_lote = asyncio.create_task(self._enviar_pendentes())
+
+        return await futuro
+
+    async def _enviar_pendentes(self):
+        """Envia os prompts pendentes em lotes até a fila esvaziar"""
+        while self._pendentes:
+            await self._processar_lote()
+
+    async def _processar_lote(self):
+        """Calcula os embeddings pendentes com uma única chamada à API"""
+        lote = self._pendentes[: self.tamanho_lote]
+        del self._pendentes[: self.tamanho_lote]
+        if not lote:
+            return
+
+        try:
+            resultado = await genai.embed_content_async(
+                model=self.modelo_embedding, content=[prompt for prompt, _ in lote]
+            )
+            matriz = np.asarray(resultado["embedding"], dtype=np.float32)
+            matriz /= np.linalg.norm(matriz, axis=1, keepdims=True)
+        except Exception as e:
+            for _, futuro in lote:
+                if not futuro.done():
+                    futuro.set_exception(e)
+            return
+
+        for (_, futuro), q in zip(lote, matriz):
+            if not futuro.done():
+                futuro.set_result(q)
+
+    def _consolidar(self):
+        """Incorpora as inserções pendentes em E com um único vstack por contexto"""
+        if not self._insercoes:
+            return
+
+        por_contexto: Dict[bytes, list] = {}
+        for contexto, q, resposta, agora in self._insercoes:
+            por_contexto.setdefault(contexto, []).append((q, resposta, agora))
+        self._insercoes = []
+
+        for contexto, novos in por_contexto.items():
+            vetores, respostas, timestamps = zip(*novos)
+            bloco = np.vstack(vetores)
+            if contexto in self._grupos:
+                matriz, anteriores, tempos = self._grupos[contexto]
+                bloco = np.vstack([matriz, bloco])
+                respostas = anteriores + list(respostas)
+                timestamps = tempos + list(timestamps)
+            self._grupos[contexto] = (bloco, list(respostas), list(timestamps))
+
+    def tem_contexto(self, contexto: bytes) -> bool:
+        """Indica se há entradas no contexto (sem elas, não há o que comparar)"""
+        self._consolidar()
+        return contexto in self._grupos
+
+    def buscar_semantico(self, contexto: bytes, q: np.ndarray) -> Optional[str]:
+        """Retorna a resposta mais similar a q no mesmo contexto, se acima do limiar"""
+        self._consolidar()
+        self._expirar()
+        if contexto not in self._grupos:
+            return None
+
+        matriz, respostas, _ = self._grupos[contexto]
+        scores = matriz @ q  # Similaridade de cosseno (vetores normalizados)
+        melhor = int(np.argmax(scores))
+        if scores[melhor] >= self.limiar:
+            return respostas[melhor]
+        return None
+
+    def geracao_em_andamento(self, prompt: str) -> Optional[asyncio.Future]:
+        """Retorna o futuro da geração do mesmo prompt já em andamento, se houver"""
+        return self._em_andamento.get(self._chave(prompt))
+
+    def iniciar_geracao(self, prompt: str) -> asyncio.Future:
+        """Registra a geração do prompt para que chamadores concorrentes a aguardem"""
+        # Resultado: a resposta, a exceção da chamada ou None se ela for abandonada
+        futuro = asyncio.get_running_loop().create_future()
+        # Marca a exceção como lida mesmo que ninguém aguarde o futuro
+        futuro.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._em_andamento[self._chave(prompt)] = futuro
+        return futuro
+
+    def encerrar_geracao(self, prompt: str):
+        """Remove o registro da geração do prompt"""
+        self._em_andamento.pop(self._chave(prompt), None)
+
+    def registrar_chave(self, chave: Any, resposta: str):
+        """Armazena a resposta sob uma chave calculada pelo chamador"""
+        self._exatos[chave] = (time.monotonic(), resposta)
+
+    def adicionar(
+        self,
+        prompt: str,
+        resposta: str,
+        q: Optional[np.ndarray] = None,
+        chave: Optional[bytes] = None,
+        contexto: Optional[bytes] = None,
+    ):
+        """Armazena a resposta do prompt (e seu embedding / chave extra, se houver)"""
+        agora = time.monotonic()
+        self._exatos[self._chave(prompt)] = (agora, resposta)
+        if chave is not None:
+            self._exatos[chave] = (agora, resposta)
+
+        if q is not None and contexto is not None:
+            # Entra em E na próxima busca, junto com as demais inserções
+            self._insercoes.append((contexto, q, resposta, agora))
+
+    def __len__(self) -> int:
+        return len(self._exatos)
+
+
+# Cache padrão, compartilhado por todos os agentes do processo: respostas e
+# lotes de embeddings de um agente servem aos demais
+_cache_compartilhado = LLMCache()
+
+
 # ========== AGENTE PRINCIPAL ==========
 
 
@@ -98,16 +420,41 @@ class MeuPrimeiroAgente:  # MeuPrimeiroAgente é uma classe que representa um ag
         nome: str,  # Nome do agente
         modelo: str = "gemini-2.0-flash",  # Modelo de IA a ser usado
         temperatura: float = 0.5,
+        cache: Optional[LLMCache] = None,  # Cache de respostas (padrão: compartilhado)
     ):
         self.nome = nome  # Nome do agente
         self.modelo = modelo  # Modelo de IA a ser usado
-        self.client = genai.GenerativeModel(modelo)  # Cliente Gemini
+        _configure_once()
+        self.client = _get_model(modelo)  # Cliente Gemini (compartilhado por modelo)
         self.temperatura = self._validar_temperatura(
             temperatura
         )  # Temperatura do agente
         self._historico: List[Mensagem] = []  # Histórico de mensagens
-        self._ferramentas: Dict[str, Ferramenta] = {}  # Ferramentas do agente
+        self._prompt_buffer: List[str] = []  # Linhas do prompt, uma por mensagem
+        self._history_hash = hashlib.blake2b(digest_size=16)  # Hash incremental
+        self._ferramentas: Dict[str, Callable[..., Any]] = {}  # Nome -> função
+        self._metadados_ferramentas: Dict[str, Ferramenta] = {}  # Nome -> descrição
         self._limite_contexto = 4096  # Limite de contexto do agente
+        # Turnos recentes (pares user/assistant) enviados ao modelo além do sistema
+        self._max_turns = 20
+        self._token_count = 0  # Estimativa de tokens mantida em adicionar_mensagem
+        # Estimativa acumulada até cada mensagem: tokens de qualquer trecho em O(1)
+        self._tokens_acumulados: List[int] = []
+        self._cache = cache if cache is not None else _cache_compartilhado
+
+        # Cache de contexto no provedor (prefixo do histórico armazenado no Gemini)
+        self._limite_cache_contexto = 4096  # Mínimo de tokens aceito pelo provedor
+        self._cache_contexto_ativo = True  # Desligado se o provedor recusar o cache
+        self._max_pendentes_cache = 8  # Mensagens fora do cache antes de recriá-lo
+        self._cache_contexto: Optional[caching.CachedContent] = None
+        self._cliente_cache: Optional[genai.GenerativeModel] = None
+        self._cache_len = 0  # Quantas mensagens do histórico estão no cache
+        # (gerador, partes já entregues) da resposta em streaming ainda não registrada
+        self._resposta_ativa: Optional[Tuple[AsyncIterator[str], List[str]]] = None
+        self._log_fh: Optional[BinaryIO] = None  # Log JSONL incremental (abrir_log)
+        self._arquivo_log: Optional[str] = None
+        # (caminho, nº de mensagens) de um log que já corresponde ao histórico
+        self._log_sincronizado: Optional[Tuple[str, int]] = None
 
         # Mensagem de sistema padrão
         self.adicionar_mensagem(
@@ -122,97 +469,463 @@ class MeuPrimeiroAgente:  # MeuPrimeiroAgente é uma classe que representa um ag
         return valor
 
     @property  # @property é um decorador que permite que um método seja acessado como um atributo
-    def historico(self) -> List[Mensagem]:
-        """Retorna cópia do histórico"""
-        return self._historico.copy()
+    def historico(self) -> Sequence[Mensagem]:
+        """Retorna o histórico sem copiar (somente leitura)"""
+        return self.historico_view()
+
+    def historico_view(self) -> Sequence[Mensagem]:
+        """Retorna o histórico interno sem cópia; não deve ser modificado"""
+        return self._historico
+
+    def historico_snapshot(self) -> Tuple[Mensagem, ...]:
+        """Retorna uma cópia imutável do histórico neste momento"""
+        return tuple(self._historico)
 
     @property  # @property é um decorador que permite que um método seja acessado como um atributo
     def tokens_estimados(self) -> int:
         """Estima tokens usados"""
-        return sum(len(msg.content.split()) for msg in self._historico)
+        return self._token_count
+
+    def _inicio_janela(self) -> int:
+        """Índice da primeira mensagem (após o sistema) dentro da janela recente"""
+        # Cada turno tem duas mensagens (user + assistant)
+        return max(1, len(self._prompt_buffer) - 2 * self._max_turns)
+
+    def _tokens_transcricao(self) -> int:
+        """Estima tokens da janela enviada ao cache (sem sistema e mensagem atual)"""
+        return (
+            self._tokens_acumulados[-2]
+            - self._tokens_acumulados[self._inicio_janela() - 1]
+        )
 
     def adicionar_mensagem(self, role: Role, content: str):
         """Adiciona mensagem ao histórico"""
         msg = Mensagem(role, content)
         self._historico.append(msg)
+        linha = f"{msg._role_str}: {content}\n"
+        self._prompt_buffer.append(linha)
+        self._history_hash.update(linha.encode("utf-8"))
+        self._token_count += content.count(" ") + 1  # Conta sem criar lista
+        self._tokens_acumulados.append(self._token_count)
 
-        # Log simples
-        print(f"[{role.value.upper()}] {content[:50]}...")
+        # Persistência incremental: uma linha por mensagem, só acrescentando
+        if self._log_fh is not None:
+            self._log_fh.write(self._linha_jsonl(msg))
+            self._log_fh.flush()
+
+        # Log simples (o recorte do conteúdo só é feito se o nível DEBUG estiver ativo)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[%s] %s...", msg._role_str.upper(), content[:50])
 
     def registrar_ferramenta(self, ferramenta: Ferramenta):
         """Registra uma ferramenta para o agente usar"""
-        self._ferramentas[ferramenta.nome] = ferramenta
-        print(f"Ferramenta registrada: {ferramenta.nome}")
+        # Guarda a função diretamente: a chamada não passa por Ferramenta.__call__
+        self._ferramentas[ferramenta.nome] = ferramenta.func
+        self._metadados_ferramentas[ferramenta.nome] = ferramenta
+        logger.debug("Ferramenta registrada: %s", ferramenta.nome)
 
     async def processar_mensagem(
         self, mensagem: str, usar_ferramentas: bool = True
-    ) -> str:
+    ) -> AsyncIterator[str]:
         """
         Processa mensagem do usuário usando Google Gemini
+
+        A resposta é produzida em partes (streaming), à medida que o modelo gera:
+        use `async for parte in agente.processar_mensagem(...)`.
+
+        Se o chamador sair antes do fim (`break`), o texto parcial é registrado no
+        histórico ao fechar o gerador (`contextlib.aclosing`) ou, no mais tardar,
+        no início da próxima mensagem.
         """
+        # Resposta anterior abandonada com `break`: o Python só fecharia o gerador
+        # depois, pelo coletor de lixo, e os turnos ficariam intercalados
+        await self._encerrar_resposta_ativa()
+
+        partes: List[str] = []
+        respostas = self._responder(mensagem, usar_ferramentas)
+        ativa = (respostas, partes)
+        self._resposta_ativa = ativa
+        try:
+            async for parte in respostas:
+                partes.append(parte)
+                yield parte
+        finally:
+            if self._resposta_ativa is ativa:
+                await self._encerrar_resposta_ativa()
+
+    async def _encerrar_resposta_ativa(self):
+        """Fecha a resposta em andamento e registra o texto produzido até aqui"""
+        if self._resposta_ativa is None:
+            return
+        respostas, partes = self._resposta_ativa
+        self._resposta_ativa = None
+        await respostas.aclose()
+        # Mantém user/assistant alternados, mesmo com resposta parcial
+        self.adicionar_mensagem(Role.ASSISTANT, "".join(partes))
+
+    async def _responder(
+        self, mensagem: str, usar_ferramentas: bool
+    ) -> AsyncIterator[str]:
+        """Adiciona a mensagem do usuário e produz as partes da resposta"""
+        # Hash do histórico antes da nova mensagem (contexto da busca semântica)
+        historico_anterior = self._history_hash.digest()
+
+        # Chave do histórico com a nova mensagem, sem percorrer o histórico
+        chave = self._history_hash.copy()
+        chave.update(f"{self.modelo}\n".encode("utf-8"))
+        chave.update(f"{Role.USER.value}: {mensagem}\n".encode("utf-8"))
+        # Ferramentas registradas entram na chave: o acerto dispensa executá-las
+        ferramentas = ",".join(sorted(self._ferramentas)) if usar_ferramentas else ""
+        chave.update(f"[{ferramentas}]".encode("utf-8"))
+        chave = chave.digest()
+
         # Adiciona mensagem do usuário
         self.adicionar_mensagem(Role.USER, mensagem)
-        print(f"{self.nome} está pensando...")
+
+        # Acerto exato: dispensa ferramentas, montagem do prompt e chamada à API
+        resposta_texto = self._cache.buscar_chave(chave)
+        if resposta_texto is not None:
+            yield resposta_texto
+            return
+
+        logger.debug("%s está pensando...", self.nome)
 
         contexto_ferramenta = ""
 
         # Lógica Simples de Ferramentas (ReAct simplificado)
         if usar_ferramentas:
-            if "calcular" in mensagem.lower():
-                if "calcular" in self._ferramentas:
-                    try:
-                        resultado = self._ferramentas["calcular"](expressao=mensagem)
-                        contexto_ferramenta = f"\n[SISTEMA] O usuário pediu um cálculo. Resultado da ferramenta: {resultado}. Use isso para responder."
-                    except Exception as e:
-                        contexto_ferramenta = f"\n[SISTEMA] Erro ao calcular: {str(e)}"
-
-            elif "pesquisar" in mensagem.lower():
-                if "buscar" in self._ferramentas:
-                    termos = mensagem.replace("pesquisar", "").strip()
-                    resultado = self._ferramentas["buscar"](termo=termos)
-                    contexto_ferramenta = f"\n[SISTEMA] Resultado da busca: {resultado}. Use isso para responder."
-
-        # Constrói o histórico para o prompt
-        prompt_completo = ""
-        for msg in self._historico:
-            prompt_completo += f"{msg.role.value}: {msg.content}\n"
-
-        prompt_completo += contexto_ferramenta
-        prompt_completo += "\nassistant:"
+            contexto_ferramenta = await self._executar_ferramentas(mensagem)
+
+        # Constrói o prompt a partir do buffer mantido em adicionar_mensagem,
+        # com a mensagem de sistema e apenas os últimos `_max_turns` turnos
+        sufixo = contexto_ferramenta + "\nassistant:"
+        prompt_completo = (
+            self._prompt_buffer[0]
+            + "".join(self._prompt_buffer[self._inicio_janela() :])
+            + sufixo
+        )
+
+        # Consulta o cache: primeiro por hash exato, depois por similaridade
+        # Respostas só são gravadas com temperatura 0 (determinísticas)
+        gravar_cache = self.temperatura == 0
+        # O modelo faz parte das chaves: o cache é compartilhado entre agentes
+        prompt_modelo = f"{self.modelo}\n{prompt_completo}"
+        resposta_texto = self._cache.buscar_exato(prompt_modelo)
+
+        # A similaridade compara só a nova mensagem, entre entradas com o mesmo
+        # histórico anterior e o mesmo resultado de ferramentas
+        contexto = hashlib.blake2b(
+            f"{self.modelo}\n{contexto_ferramenta}".encode("utf-8")
+            + historico_anterior,
+            digest_size=16,
+        ).digest()
+        # Só calcula o embedding antes da geração se houver com o que comparar
+        q = None
+        if resposta_texto is None and self._cache.tem_contexto(contexto):
+            try:
+                q = await self._cache.embedding(mensagem)
+                resposta_texto = self._cache.buscar_semantico(contexto, q)
+            except Exception:
+                q = None  # Falha no embedding não impede a resposta
+
+        if resposta_texto is not None:
+            if gravar_cache:
+                self._cache.registrar_chave(chave, resposta_texto)
+            yield resposta_texto  # Acerto no cache: resposta inteira de uma vez
+            return
+
+        # Chamadas determinísticas idênticas em andamento são compartilhadas
+        # (no mesmo cache e com a mesma chave em que a resposta será gravada)
+        while gravar_cache:
+            em_andamento = self._cache.geracao_em_andamento(prompt_modelo)
+            if em_andamento is None:
+                break
+            # Outro chamador já pediu a mesma resposta: aguarda o resultado dele
+            try:
+                resposta_texto = await asyncio.shield(em_andamento)
+            except Exception as e:
+                resposta_texto = f"Erro ao contatar a IA: {str(e)}"
+            if resposta_texto is not None:
+                yield resposta_texto
+                return
+            # None: o outro chamador parou de ler antes do fim; gera por conta
+            # própria (ou aguarda quem assumiu a geração antes)
+
+        futuro = None
+        tarefa_q = None
+        if gravar_cache:
+            futuro = self._cache.iniciar_geracao(prompt_modelo)
+            if q is None:
+                # Embedding para gravar no cache, calculado durante a geração
+                tarefa_q = asyncio.create_task(self._cache.embedding(mensagem))
+                tarefa_q.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+        partes: List[str] = []
+        try:
+            # Gera resposta com Gemini, repassando cada parte ao chamador
+            await self._atualizar_cache_contexto()
+            async for parte in self._gerar_resposta(prompt_completo, sufixo):
+                partes.append(parte)
+                yield parte
+            resposta_texto = "".join(partes)
+            if futuro is not None:
+                futuro.set_result(resposta_texto)
+            if tarefa_q is not None:
+                try:
+                    q = await tarefa_q
+                except Exception:
+                    q = None  # Sem embedding, grava só as chaves exatas
+            if gravar_cache:
+                self._cache.adicionar(prompt_modelo, resposta_texto, q, chave, contexto)
+        except Exception as e:
+            if futuro is not None and not futuro.done():
+                futuro.set_exception(e)
+            yield f"Erro ao contatar a IA: {str(e)}"
+        finally:
+            if tarefa_q is not None and not tarefa_q.done():
+                tarefa_q.cancel()
+            if futuro is not None:
+                self._cache.encerrar_geracao(prompt_modelo)
+                if not futuro.done():
+                    # Geração abandonada pelo chamador (ex.: saiu do async for):
+                    # quem aguardava faz a própria chamada
+                    futuro.set_result(None)
+
+    async def _executar_ferramentas(self, mensagem: str) -> str:
+        """Executa em paralelo as ferramentas acionadas pela mensagem"""
+        chamadas = {}  # Nome da ferramenta -> chamada (cada uma roda uma vez)
+        for gatilho in _TOOL_RE.finditer(mensagem):
+            nome = "calcular" if gatilho.lastgroup == "calc" else "buscar"
+            if nome in chamadas or nome not in self._ferramentas:
+                continue
+            if nome == "calcular":
+                chamadas[nome] = asyncio.to_thread(
+                    self._ferramentas["calcular"], expressao=mensagem
+                )
+            else:
+                termos = (
+                    mensagem[: gatilho.start()] + mensagem[gatilho.end() :]
+                ).strip()
+                chamadas[nome] = asyncio.to_thread(
+                    self._ferramentas["buscar"], termo=termos
+                )
+
+        if not chamadas:
+            return ""
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Usando ferramentas: %s", ", ".join(chamadas))
+
+        # As ferramentas são síncronas: cada uma roda em uma thread, ao mesmo tempo
+        resultados = await asyncio.gather(*chamadas.values(), return_exceptions=True)
 
+        contexto_ferramenta = ""
+        for nome, resultado in zip(chamadas, resultados):
+            if nome == "calcular":
+                if isinstance(resultado, Exception):
+                    contexto_ferramenta += (
+                        f"\n[SISTEMA] Erro ao calcular: {str(resultado)}"
+                    )
+                else:
+                    contexto_ferramenta += f"\n[SISTEMA] O usuário pediu um cálculo. Resultado da ferramenta: {resultado}. Use isso para responder."
+            else:
+                if isinstance(resultado, Exception):
+                    raise resultado
+                contexto_ferramenta += f"\n[SISTEMA] Resultado da busca: {resultado}. Use isso para responder."
+        return contexto_ferramenta
+
+    async def _atualizar_cache_contexto(self):
+        """Cria ou recria o cache de contexto quando o histórico cresce"""
+        # Só a janela recente vai para o cache: é ela que precisa do mínimo
+        if (
+            not self._cache_contexto_ativo
+            or self._tokens_transcricao() < self._limite_cache_contexto
+        ):
+            return
+
+        # A mensagem atual do usuário fica fora do cache
+        pendentes = len(self._historico) - 1 - self._cache_len
+        if self._cache_len and pendentes <= self._max_pendentes_cache:
+            return
+
+        await self._descartar_cache_contexto()
+        transcricao = "".join(self._prompt_buffer[self._inicio_janela() : -1])
         try:
-            # Gera resposta com Gemini
-            response = await self.client.generate_content_async(prompt_completo)
-            resposta_texto = response.text
+            self._cache_contexto = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=_modelo_versionado(self.modelo),
+                system_instruction=self._historico[0].content,
+                contents=[transcricao],
+                ttl="5m",
+            )
+            self._cliente_cache = genai.GenerativeModel.from_cached_content(
+                self._cache_contexto
+            )
+        except google_exceptions.InvalidArgument as e:
+            if "too small" in str(e).lower():
+                # A estimativa ficou acima da contagem do provedor: tenta de novo
+                # quando a janela tiver mais mensagens
+                logger.debug("Conteúdo pequeno demais para o cache: %s", e)
+            else:
+                # Modelo não aceito pelo cache: não adianta tentar de novo
+                self._cache_contexto_ativo = False
+                logger.warning("Cache de contexto desativado: %s", e)
         except Exception as e:
-            resposta_texto = f"Erro ao contatar a IA: {str(e)}"
+            logger.warning("Cache de contexto indisponível: %s", e)
+
+        # Mesmo em caso de falha, só tenta de novo após novas mensagens
+        self._cache_len = len(self._historico) - 1
+
+    async def _descartar_cache_contexto(self):
+        """Remove o cache de contexto atual do provedor sem bloquear o event loop"""
+        if self._cache_contexto is not None:
+            await asyncio.to_thread(self._apagar_cache_contexto)
+
+    def _apagar_cache_contexto(self):
+        """Remove o cache de contexto atual do provedor"""
+        if self._cache_contexto is not None:
+            try:
+                self._cache_contexto.delete()
+            except Exception:
+                pass  # O cache expira sozinho pelo TTL
+        self._cache_contexto = None
+        self._cliente_cache = None
+
+    @staticmethod
+    def _usar_cliente_compartilhado(modelo: genai.GenerativeModel):
+        """Faz o modelo usar o cliente com keep-alive do event loop atual"""
+        # O modelo é compartilhado (_get_model) e pode guardar o cliente de um loop
+        # anterior (ex.: outro asyncio.run), por isso compara a cada chamada
+        cliente = _cliente_async_compartilhado()
+        if getattr(modelo, "_async_client", None) is not cliente:
+            modelo._async_client = cliente
+
+    def _configuracao_geracao(self) -> Dict[str, Any]:
+        """Parâmetros de geração do agente, enviados a cada chamada
+
+        O modelo é compartilhado entre agentes (_get_model), então a temperatura
+        não pode ficar no objeto do modelo.
+        """
+        return {"temperature": self.temperatura}
+
+    async def _gerar_resposta(
+        self, prompt_completo: str, sufixo: str
+    ) -> AsyncIterator[str]:
+        """Gera resposta com Gemini em streaming, enviando só o que não está no cache"""
+        response = None
+        if self._cliente_cache is not None:
+            self._usar_cliente_compartilhado(self._cliente_cache)
+            prompt_novo = "".join(self._prompt_buffer[self._cache_len :])
+            try:
+                response = await self._cliente_cache.generate_content_async(
+                    prompt_novo + sufixo,
+                    stream=True,
+                    generation_config=self._configuracao_geracao(),
+                )
+            except Exception:
+                # Cache expirado ou inválido: volta a enviar o histórico completo
+                await self._descartar_cache_contexto()
+                self._cache_len = 0
+
+        if response is None:
+            self._usar_cliente_compartilhado(self.client)
+            response = await self.client.generate_content_async(
+                prompt_completo,
+                stream=True,
+                generation_config=self._configuracao_geracao(),
+            )
 
-        # Adiciona resposta ao histórico
-        self.adicionar_mensagem(Role.ASSISTANT, resposta_texto)
+        async for chunk in response:
+            yield chunk.text
 
-        return resposta_texto
+    @staticmethod
+    def _serializar(msg: Mensagem) -> Dict[str, Any]:
+        """Converte mensagem para o formato salvo em arquivo"""
+        return {
+            "role": msg._role_str,
+            "content": msg.content,
+            "timestamp": msg.timestamp,  # O orjson formata datetime em C (ISO 8601)
+        }
+
+    @staticmethod
+    def _json_default(obj: Any) -> Any:
+        """Formata datetime quando o json da biblioteca padrão é usado"""
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        raise TypeError(f"Tipo não serializável: {type(obj).__name__}")
+
+    @classmethod
+    def _linha_jsonl(cls, msg: Mensagem) -> bytes:
+        """Serializa mensagem como uma linha JSONL"""
+        dados = cls._serializar(msg)
+        if orjson is not None:
+            return orjson.dumps(dados) + b"\n"
+        linha = json.dumps(dados, ensure_ascii=False, default=cls._json_default)
+        return linha.encode("utf-8") + b"\n"
+
+    def abrir_log(self, arquivo: str):
+        """Passa a gravar cada nova mensagem em um arquivo JSONL"""
+        self.fechar_log()
+        caminho = os.path.abspath(arquivo)
+
+        # Só continua o arquivo se ele já contém exatamente este histórico
+        # (carregado dele ou gravado nele); senão o reescreve do zero
+        if self._log_sincronizado == (caminho, len(self._historico)):
+            self._log_fh = open(caminho, "ab")
+        else:
+            self._log_fh = open(caminho, "wb")
+            self._log_fh.write(b"".join(map(self._linha_jsonl, self._historico)))
+            self._log_fh.flush()
+        self._arquivo_log = caminho
+        logger.info("Log da conversa em %s", arquivo)
+
+    def fechar_log(self):
+        """Encerra a gravação incremental da conversa"""
+        if self._log_fh is not None:
+            self._log_fh.close()
+            self._log_fh = None
+            self._log_sincronizado = (self._arquivo_log, len(self._historico))
+            self._arquivo_log = None
 
     def salvar_conversa(self, arquivo: str):
-        """Salva histórico em arquivo"""
-        dados = [
-            {
-                "role": msg.role.value,
-                "content": msg.content,
-                "timestamp": msg.timestamp.isoformat(),
-            }
-            for msg in self._historico
-        ]
-
-        with open(arquivo, "w") as f:
-            json.dump(dados, f, indent=2, ensure_ascii=False)
-        print(f"Conversa salva em {arquivo}")
+        """Salva histórico completo em arquivo (exportação em bloco)"""
+        dados = [self._serializar(msg) for msg in self._historico]
+
+        if orjson is not None:
+            Path(arquivo).write_bytes(
+                orjson.dumps(
+                    dados, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+                )
+            )
+        else:
+            with open(arquivo, "w", encoding="utf-8") as f:
+                json.dump(
+                    dados,
+                    f,
+                    indent=2,
+                    ensure_ascii=False,
+                    default=self._json_default,
+                )
+        logger.info("Conversa salva em %s", arquivo)
 
     def carregar_conversa(self, arquivo: str):
-        """Carrega histórico de arquivo"""
-        with open(arquivo, "r") as f:
-            dados = json.load(f)
+        """Carrega histórico de arquivo (JSON exportado ou log JSONL)"""
+        # Um log aberto é reaberto ao final para refletir o novo histórico
+        arquivo_log = self._arquivo_log
+        self.fechar_log()
+
+        if arquivo.endswith(".jsonl"):
+            loads = orjson.loads if orjson is not None else json.loads
+            with open(arquivo, "rb") as f:
+                dados = [loads(linha) for linha in f if linha.strip()]
+        elif orjson is not None:
+            dados = orjson.loads(Path(arquivo).read_bytes())
+        else:
+            with open(arquivo, "r", encoding="utf-8") as f:
+                dados = json.load(f)
 
         self._historico = []
+        self._prompt_buffer = []
+        self._history_hash = hashlib.blake2b(digest_size=16)
         for item in dados:
             msg = Mensagem(
                 role=Role(item["role"]),
@@ -220,8 +933,27 @@ class MeuPrimeiroAgente:  # MeuPrimeiroAgente é uma classe que representa um ag
                 timestamp=datetime.fromisoformat(item["timestamp"]),
             )
             self._historico.append(msg)
+            linha = f"{msg._role_str}: {msg.content}\n"
+            self._prompt_buffer.append(linha)
+            self._history_hash.update(linha.encode("utf-8"))
+        self._tokens_acumulados = list(
+            accumulate(msg.content.count(" ") + 1 for msg in self._historico)
+        )
+        self._token_count = (
+            self._tokens_acumulados[-1] if self._tokens_acumulados else 0
+        )
+
+        # O cache de contexto anterior não corresponde mais ao histórico
+        self._apagar_cache_contexto()
+        self._cache_len = 0
+
+        self._log_sincronizado = None
+        if arquivo.endswith(".jsonl"):
+            self._log_sincronizado = (os.path.abspath(arquivo), len(self._historico))
+        if arquivo_log is not None:
+            self.abrir_log(arquivo_log)
 
-        print(f"Conversa carregada: {len(self._historico)} mensagens")
+        logger.info("Conversa carregada: %d mensagens", len(self._historico))
 
     def __str__(self) -> str:
         return (
@@ -234,25 +966,70 @@ class MeuPrimeiroAgente:  # MeuPrimeiroAgente é uma classe que representa um ag
 
 # ========== FERRAMENTAS DE EXEMPLO ==========
 
+_MAX_EXPOENTE = 100  # Limite de ** para não travar com números gigantes
+
+
+def _potencia(base: float, expoente: float) -> float:
+    """Potência com expoente limitado (ex.: 9**9**9 seria inviável)"""
+    if abs(expoente) > _MAX_EXPOENTE:
+        raise ValueError(f"Expoente acima de {_MAX_EXPOENTE}")
+    return operator.pow(base, expoente)
+
+
+# Operadores aceitos pelo avaliador de expressões
+_OPERADORES_BINARIOS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Pow: _potencia,
+}
+_OPERADORES_UNARIOS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+def _eval_ast(node: ast.AST) -> float:
+    """Avalia um nó da AST aceitando apenas números e operadores aritméticos"""
+    if isinstance(node, ast.Expression):
+        return _eval_ast(node.body)
+    if isinstance(node, ast.BinOp) and type(node.op) in _OPERADORES_BINARIOS:
+        return _OPERADORES_BINARIOS[type(node.op)](
+            _eval_ast(node.left), _eval_ast(node.right)
+        )
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _OPERADORES_UNARIOS:
+        return _OPERADORES_UNARIOS[type(node.op)](_eval_ast(node.operand))
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    raise ValueError(f"Elemento não permitido na expressão: {type(node).__name__}")
+
+
+@lru_cache(maxsize=256)
+def _avaliar_expressao(expressao: str) -> float:
+    """Avalia expressão aritmética sem eval (memoizado por expressão)"""
+    return _eval_ast(ast.parse(expressao, mode="eval"))
+
 
 def ferramenta_calcular(expressao: str) -> float:
     """Calcula expressão matemática simples de forma segura"""
     try:
         # Tenta encontrar uma expressão matemática válida na string
         # Padrão: números seguidos de operadores/números/espaços
-        match = re.search(r"([\d\.\s\(\)]*[\+\-\*\/][\d\.\s\(\)\+\-\*\/]*)", expressao)
+        match = _EXPR_RE.search(expressao)
 
         if not match:
             # Tenta apenas um número se não houver operadores (ex: "calcular 10")
-            match_num = re.search(r"(\d+)", expressao)
+            match_num = _NUM_RE.search(expressao)
             if match_num:
                 return float(match_num.group(1))
             return "Erro: Nenhuma expressão matemática encontrada."
 
         expressao_encontrada = match.group(1).strip()
 
-        # Avalia a expressão encontrada
-        resultado = eval(expressao_encontrada)
+        # Avalia a expressão encontrada (sem eval, apenas aritmética)
+        resultado = _avaliar_expressao(expressao_encontrada)
         return resultado
     except Exception:
         return "Erro no cálculo"
@@ -277,6 +1054,9 @@ async def main():
     )
     print(agente)
 
+    # Grava cada mensagem da conversa assim que ela acontece
+    agente.abrir_log(os.path.join(BASE_DIR, "minha_conversa.jsonl"))
+
     # Registra ferramentas
     agente.registrar_ferramenta(
         Ferramenta("calcular", "Calcula expressões matemáticas", ferramenta_calcular)
@@ -285,12 +1065,12 @@ async def main():
         Ferramenta("buscar", "Busca informações na web", ferramenta_buscar)
     )
 
-    # Conversa
-    resposta = await agente.processar_mensagem("Olá, tudo bem?")
-    print(f"Resposta: {resposta}")
-
-    resposta = await agente.processar_mensagem("Calcule 10+2+5?")
-    print(f"Resposta: {resposta}")
+    # Conversa (a resposta é exibida à medida que chega)
+    for pergunta in ("Olá, tudo bem?", "Calcule 10+2+5?"):
+        print("Resposta: ", end="", flush=True)
+        async for parte in agente.processar_mensagem(pergunta):
+            print(parte, end="", flush=True)
+        print()
 
     # Estatísticas
     print(f"\nEstatísticas:")
@@ -301,6 +1081,7 @@ async def main():
     # Salva conversa no diretório da aula
     json_path = os.path.join(BASE_DIR, "minha_conversa.json")
     agente.salvar_conversa(json_path)
+    agente.fechar_log()
 
     print("=" * 50)
 